@@ -1,6 +1,8 @@
 import asyncio
+import json
 import logging
-import copy
+from collections import deque
+from typing import List, Optional
 
 from nio import (
     AsyncClient,
@@ -11,16 +13,33 @@ from nio import (
     RoomCreateResponse,
     RoomMemberEvent,
     ErrorResponse,
+    SyncResponse,
 )
 
-from bot_messenger.chat_functions import create_private_room, find_private_msg, is_ready_to_send_message, send_message_to_room, with_ratelimit
+from bot_messenger.chat_functions import create_private_room, find_private_msg, is_ready_to_send_message, send_message_to_room, send_text_to_room
 from bot_messenger.config import Config
-from bot_messenger.messages import BaseMessage
+from bot_messenger.messages import BaseMessage, TextMessage, message_pool
+from bot_messenger.pending import PendingStore
 from bot_messenger.storage import Storage
+from bot_messenger.utils import with_ratelimit
 
 logger = logging.getLogger(__name__)
 
 DUPLICATES_CACHE_SIZE = 1000
+JOIN_ATTEMPTS = 3
+JOIN_RETRY_BASE_DELAY = 0.2 # Seconds, doubled after every failed join attempt
+MAX_SEND_BATCH = 16 # Queued messages taken at once by a room send worker
+SEND_BATCH_WINDOW = 0.05 # Seconds a room send worker waits for more messages to batch with the next one
+# Bytes of JSON-escaped text merged into a single Matrix message. Matrix events are capped at 64 KiB,
+# the body is sent a second time as formatted HTML and Megolm encryption adds a third on top.
+MAX_COALESCED_SIZE = 8192
+COALESCE_SEPARATOR = "\n\n"
+
+def encoded_size(text: str) -> int:
+    """Bytes a string takes up in a JSON encoded event, non-ASCII characters are escaped as \\uXXXX."""
+    return len(json.dumps(text)) - 2 # Without the quotes
+
+_SEPARATOR_SIZE = encoded_size(COALESCE_SEPARATOR)
 
 class Callbacks:
     def __init__(self, client: AsyncClient, store: Storage, config: Config):
@@ -35,26 +54,88 @@ class Callbacks:
         self.client = client
         self.store = store
         self.config = config
+
+        # The bot's own user id is fixed at client construction, look it up once instead of per event
+        self._own_user = client.user
+
+        # Room member events in the notifications room are ignored, a real room id never equals None
+        self._notif_room_id = config.notifications_room or None
         
-        self.received_events = []
+        # Recently processed event ids - the deque keeps insertion order for eviction, the set gives O(1) lookups.
+        # A bloom filter in front of the set would not pay off: hashing the event id in Python costs more than the set lookup.
+        self.received_events_deque: deque[str] = deque(maxlen=DUPLICATES_CACHE_SIZE)
+        self.received_events_set: set[str] = set()
         
+        # Private room of each user, kept up to date from membership events - avoids scanning all joined rooms for every message (user_id : room_id)
+        self._dm_index: dict[str, str] = {}
+        self._dm_index_built = False
+
         # Store messages until room is created - prevents multiple rooms from being created when multiple messages are received.
-        self.user_rooms_pending:dict[str, str] = {} # User ids with DMs encryption pending  (user_id : room_id)
+        self.user_rooms_pending:dict[str, list[BaseMessage]] = {} # User ids with DMs creation pending  (user_id : [message])
         
         # Store messages until room is encrypted and recipient has joined the room before sending the message out - prevents missing encryption keys.
-        self.rooms_pending:dict[str, list[BaseMessage]] = {} # Room ids with encryption pending (room_id : [message])
+        self.rooms_pending = PendingStore() # Room ids with encryption pending (room_id : [message])
+
+        # Rooms known to be encrypted with the recipient joined - skips re-checking room state on every event
+        self._room_ready: set[str] = set()
+
+        # Messages ready to be sent out, drained by a background worker per room - keeps sending off the callback path.
+        self._send_queues: dict[str, asyncio.Queue[BaseMessage]] = {} # (room_id : queue)
+        self._send_workers: dict[str, asyncio.Task] = {} # (room_id : worker task)
+
+        # Bounds the batches being sent to Matrix at once across all room workers
+        self._send_slots = asyncio.Semaphore(config.callback_workers)
 
-    def trim_duplicates_caches(self):
-        if len(self.received_events) > DUPLICATES_CACHE_SIZE:
-            self.received_events = self.received_events[:DUPLICATES_CACHE_SIZE]
-    
     def should_process(self, event_id: str) -> bool:
         logger.debug("Callback received event: %s", event_id)
-        if event_id in self.received_events:
+        if event_id in self.received_events_set:
             logger.debug("Skipping %s as it's already processed", event_id)
             return False
-        self.received_events.insert(0, event_id)
+        # The deque drops its oldest entry once full, so forget it in the set as well
+        if len(self.received_events_deque) == self.received_events_deque.maxlen:
+            self.received_events_set.discard(self.received_events_deque[-1])
+        self.received_events_deque.appendleft(event_id)
+        self.received_events_set.add(event_id)
         return True
+
+    def _find_private_room_id(self, user_id: str) -> Optional[str]:
+        """Get the id of the private room shared with a user, falling back to a scan of all rooms on an index miss.
+
+        Args:
+            user_id: The user to find the private room of.
+        """
+        room_id = self._dm_index.get(user_id)
+        if room_id is not None:
+            room = self.client.rooms.get(room_id)
+            # A freshly created room is only known to the client after the next sync
+            if room is None or room.member_count == 2:
+                return room_id
+            del self._dm_index[user_id]
+
+        msg_room = find_private_msg(self.client, user_id)
+        if msg_room is None:
+            return None
+        self._dm_index[user_id] = msg_room.room_id
+        return msg_room.room_id
+
+    def index_private_rooms(self):
+        """Add the private rooms of all rooms known to the client to the private room index."""
+        for room in self.client.rooms.values():
+            if room.member_count != 2:
+                continue
+            for user_id in (*room.users, *room.invited_users):
+                if user_id != self._own_user:
+                    self._dm_index.setdefault(user_id, room.room_id)
+                    break
+
+    def _forget_private_room(self, room_id: str):
+        """Drop index entries pointing to a room that is no longer private.
+
+        Args:
+            room_id: The room to forget.
+        """
+        for user_id in [user_id for user_id, dm_room_id in self._dm_index.items() if dm_room_id == room_id]:
+            del self._dm_index[user_id]
     
     async def notification(self, message:BaseMessage):
         """Send message to corresponding recipient type.
@@ -62,43 +143,209 @@ class Callbacks:
         Args:
             message: The message to send.
         """
-        print("Sending message")
-        print(message)
+        logger.debug("Sending message: %s", message)
         # Check if message contains room_id recipient, otherwise find room with the corresponding recipient user_id
         if message.recipient_room_id is not None:
-            await send_message_to_room(self.client, message)
+            self._ensure_worker(message.recipient_room_id).put_nowait(message)
         else:
             recipient_id = message.recipient_user_id
             if recipient_id in self.user_rooms_pending:
                 self.user_rooms_pending[recipient_id].append(message)
                 return # Room creation is being handled by a previous message
             
-            msg_room = find_private_msg(self.client, message.recipient_user_id) # DOES NOT WORK IF USER IS HAS NOT JOINED YET
+            recipient_room_id = self._find_private_room_id(recipient_id)
             
-            if msg_room is None:
+            if recipient_room_id is None:
                 self.user_rooms_pending[recipient_id] = []#{"pending_room_id": None, "messages":[]}
                 resp = await create_private_room(self.client, message.recipient_user_id, "Messenger room")
                 if isinstance(resp, RoomCreateResponse):
                     recipient_room_id = resp.room_id
-                    self.rooms_pending[recipient_room_id] = copy.deepcopy(self.user_rooms_pending[recipient_id])
-                    del self.user_rooms_pending[recipient_id]
+                    self._dm_index[recipient_id] = recipient_room_id
+                    pending = self.user_rooms_pending.pop(recipient_id, [])
                     
                     # Add the current message
-                    self.rooms_pending[recipient_room_id].append(message)
+                    pending.append(message)
                     # Update message room ids
-                    for msg in self.rooms_pending[recipient_room_id]:
+                    for msg in pending:
                         msg.recipient_room_id = recipient_room_id
+                        self._add_pending(recipient_room_id, recipient_id, msg)
                 else:
-                    logger.error(f"Failed to create room for {message.recipient_user_id}")
+                    # Drop the messages so later ones retry creating the room instead of waiting forever
+                    dropped = self.user_rooms_pending.pop(recipient_id, [])
+                    logger.error("Failed to create room for %s, dropping %d message(s)", recipient_id, len(dropped) + 1)
             else:
-                recipient_room_id = msg_room.room_id
                 message.recipient_room_id = recipient_room_id
                 
-                if is_ready_to_send_message(self.client, recipient_room_id, message.recipient_user_id):
-                    logger.debug(f"Found existing room for {message.recipient_user_id}: {recipient_room_id}")
-                    await send_message_to_room(self.client, message)
+                if recipient_room_id in self._room_ready or is_ready_to_send_message(self.client, recipient_room_id, message.recipient_user_id):
+                    self._room_ready.add(recipient_room_id)
+                    logger.debug("Found existing room for %s: %s", message.recipient_user_id, recipient_room_id)
+                    # Messages parked before the room became ready go out first
+                    if recipient_room_id in self.rooms_pending:
+                        self._flush_room(recipient_room_id)
+                    self._ensure_worker(recipient_room_id).put_nowait(message)
                 else:
-                    self.rooms_pending[recipient_room_id].append(message)
+                    self._add_pending(recipient_room_id, recipient_id, message)
+
+    def _add_pending(self, room_id: str, user_id: str, message: BaseMessage):
+        """Park a message until its room is ready, recycling any messages dropped to bound memory.
+
+        Args:
+            room_id: The room the message is addressed to.
+
+            user_id: The recipient the room belongs to.
+
+            message: The message to park.
+        """
+        for dropped in self.rooms_pending.append(room_id, user_id, message):
+            logger.warning("Dropping pending message for room %s: %s", dropped.recipient_room_id, dropped)
+            message_pool.release(dropped)
+
+    def _ensure_worker(self, room_id: str) -> asyncio.Queue:
+        """Get the send queue of a room, starting a worker to drain it if none is running.
+
+        Args:
+            room_id: The room the queued messages are sent to.
+        """
+        queue = self._send_queues.get(room_id)
+        if queue is None:
+            queue = self._send_queues[room_id] = asyncio.Queue()
+            self._send_workers[room_id] = asyncio.create_task(self._drain(room_id))
+        return queue
+
+    async def _drain(self, room_id: str):
+        """Send out queued messages of a room in order, exiting once the queue is empty.
+
+        Args:
+            room_id: The room the queued messages are sent to.
+        """
+        queue = self._send_queues[room_id]
+        try:
+            while True:
+                # Take whatever else is queued within the batch window along with the next message
+                batch = [await queue.get()]
+                if queue.qsize() < MAX_SEND_BATCH - 1:
+                    await asyncio.sleep(SEND_BATCH_WINDOW)
+                while len(batch) < MAX_SEND_BATCH and not queue.empty():
+                    batch.append(queue.get_nowait())
+
+                try:
+                    async with self._send_slots:
+                        await self._send_batch(room_id, batch)
+                except Exception:
+                    # A failed send must not strand the rest of the room's queue
+                    logger.exception("Failed to send %d message(s) to room %s", len(batch), room_id)
+                finally:
+                    for message in batch:
+                        queue.task_done()
+                        message_pool.release(message)
+
+                if queue.empty():
+                    return
+        finally:
+            # Deregister however the worker exits, so the next message starts a fresh one
+            if self._send_queues.get(room_id) is queue:
+                del self._send_queues[room_id]
+                del self._send_workers[room_id]
+
+    async def _send_batch(self, room_id: str, messages: List[BaseMessage]):
+        """Send messages to a room in order, merging consecutive text messages into one Matrix message.
+
+        Args:
+            room_id: The room the messages are sent to.
+
+            messages: The messages to send.
+        """
+        texts: list[str] = []
+        texts_size = 0
+        for message in messages:
+            text = None
+            if isinstance(message, TextMessage):
+                text = message.get_content()
+                # HTML messages are sent as is, they can't be merged with others
+                if text.startswith("<html>"):
+                    text = None
+
+            if text is not None:
+                text_size = encoded_size(text)
+                if texts and texts_size + _SEPARATOR_SIZE + text_size <= MAX_COALESCED_SIZE:
+                    texts.append(text)
+                    texts_size += _SEPARATOR_SIZE + text_size
+                    continue
+
+            await self._send_texts(room_id, texts)
+            if text is not None:
+                texts = [text]
+                texts_size = text_size
+            else:
+                texts = []
+                texts_size = 0
+                await self._send_queued(room_id, message)
+
+        await self._send_texts(room_id, texts)
+
+    async def _send_texts(self, room_id: str, texts: List[str]):
+        if not texts:
+            return
+        if len(texts) > 1:
+            logger.debug("Coalesced %d messages to room %s", len(texts), room_id)
+        try:
+            response = await send_text_to_room(self.client, room_id, COALESCE_SEPARATOR.join(texts))
+        except Exception as e:
+            logger.error("Error sending queued message to room %s: %s", room_id, e)
+            return
+        if isinstance(response, ErrorResponse):
+            logger.error("Failed to send %d message(s) to room %s: %s", len(texts), room_id, response)
+
+    async def _send_queued(self, room_id: str, message: BaseMessage):
+        try:
+            response = await send_message_to_room(self.client, message)
+        except Exception as e:
+            logger.error("Error sending queued message to room %s: %s", room_id, e)
+            return
+        if isinstance(response, ErrorResponse):
+            logger.error("Failed to send message to room %s: %s", room_id, response)
+
+    def _flush_room(self, room_id: str):
+        """Hand all messages waiting for the room to become ready over to its send worker.
+
+        Args:
+            room_id: The room the pending messages are addressed to.
+        """
+        messages = self.rooms_pending.drain(room_id)
+        logger.warning("Sending %d pending message(s) to room %s", len(messages), room_id)
+        queue = self._ensure_worker(room_id)
+        for message in messages:
+            queue.put_nowait(message)
+
+    def _check_room_ready(self, room_id: str):
+        """Flush the pending messages of a room once it becomes ready, checking its state only while not ready yet.
+
+        Args:
+            room_id: The room to check.
+        """
+        if room_id in self._room_ready:
+            if room_id in self.rooms_pending:
+                self._flush_room(room_id)
+            return
+
+        # Check if encryption satisfies conditions for sending out messages
+        user_id = self.rooms_pending.owner(room_id)
+        if user_id is not None:
+            if is_ready_to_send_message(self.client, room_id, user_id):
+                self._room_ready.add(room_id)
+                self._flush_room(room_id)
+
+    async def sync(self, response: SyncResponse) -> None:
+        """Callback for when a sync response is received.
+
+        Args:
+            response (nio.responses.SyncResponse): The sync response
+        """
+        # Membership events keep the private room index up to date, it only needs to be built from the initial state
+        if not self._dm_index_built:
+            self._dm_index_built = True
+            self.index_private_rooms()
+            logger.debug("Indexed %d private room(s)", len(self._dm_index))
 
     async def member(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
         """Callback for when a room member event is received.
@@ -109,38 +356,39 @@ class Callbacks:
             event (nio.events.room_events.RoomMemberEvent): The event
         """
         # If ignoring old messages, ignore messages older than 5 minutes
-        if self.config.notifications_room and room.room_id == self.config.notifications_room:
+        if room.room_id == self._notif_room_id:
             # Don't react to anything in the logging room
-            logger.info(f"Skipping Notifications room message {room.room_id}.")
+            logger.info("Skipping Notifications room message %s.", room.room_id)
             return
 
-        self.trim_duplicates_caches()
         if self.should_process(event.event_id) is False:
-            logger.info(f"Skipping old event in {room.room_id}")
+            logger.info("Skipping old event in %s", room.room_id)
             return
-        logger.debug(
-            f"Received a room member event for {room.display_name} | "
-            f"{event.sender}: {event.membership} {event}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Received a room member event for %s | %s: %s %s",
+                room.display_name, event.sender, event.membership, event,
+            )
 
         # Ignore our support bot membership events
-        if event.state_key == self.client.user:
-            logger.info(f"Not sharing keys with itself in {room.room_id}.")
+        if event.state_key == self._own_user:
+            if event.membership in ('leave', 'ban'):
+                self._forget_private_room(room.room_id)
+                self._room_ready.discard(room.room_id)
+            logger.info("Not sharing keys with itself in %s.", room.room_id)
             return
+
+        # Keep the private room index in sync with the room membership
+        if event.membership in ('join', 'invite') and room.member_count == 2:
+            self._dm_index[event.state_key] = room.room_id
+        elif event.membership in ('leave', 'ban'):
+            if self._dm_index.get(event.state_key) == room.room_id:
+                del self._dm_index[event.state_key]
+            self._room_ready.discard(room.room_id)
         
         # If user left their primary communications room
         if event.membership == 'join':
-            # Check if encryption satisfies conditions for sending out messages
-            if room.room_id in self.rooms_pending and len(self.rooms_pending[room.room_id]) > 0:
-                if is_ready_to_send_message(self.client, room.room_id, self.rooms_pending[room.room_id][0].recipient_user_id):
-                    for message in self.rooms_pending[room.room_id]:
-                        try:
-                            logger.warn(f"Sending message to room {room.room_id}")
-                            await send_message_to_room(self.client, message)
-                        except Exception as e:
-                            logger.error(f"Error performing queued task after joining room: {e}")
-                    # Clear tasks
-                    self.rooms_pending.pop(room.room_id)
+            self._check_room_ready(room.room_id)
 
     async def room_encryption(self, room: MatrixRoom, event: RoomEncryptionEvent) -> None:
         """Callback for when an event signaling that encryption has been enabled in a room is received
@@ -151,28 +399,24 @@ class Callbacks:
             event (nio.events.room_events.RoomEncryptionEvent): The event
         """
         
-        logger.warning(f"Room encryption enabled in room {room.room_id}")
-        # Check if encryption satisfies conditions for sending out messages
-        if room.room_id in self.rooms_pending and len(self.rooms_pending[room.room_id]) > 0:
-            if is_ready_to_send_message(self.client, room.room_id, self.rooms_pending[room.room_id][0].recipient_user_id):
-                for message in self.rooms_pending[room.room_id]:
-                    try:
-                        logger.warn(f"Sending message to room {room.room_id}")
-                        await send_message_to_room(self.client, message)
-                    except Exception as e:
-                        logger.error(f"Error performing queued task after joining room: {e}")
-                # Clear tasks
-                self.rooms_pending.pop(room.room_id)
+        logger.warning("Room encryption enabled in room %s", room.room_id)
+        self._check_room_ready(room.room_id)
     
     async def invite(self, room, event):
         """Callback for when an invitation is received. Join the room specified in the invite"""
         if self.should_process(event.source.get("event_id")) is False:
             return
-        logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
+        logger.debug("Got invite to %s from %s.", room.room_id, event.sender)
 
-        result = await with_ratelimit(self.client.join)(room.room_id)
-        if type(result) == JoinError:
-            logger.error("Unable to join room: %s", room.room_id)
+        # Attempt to join, backing off between failures in case the server error is transient
+        for attempt in range(JOIN_ATTEMPTS):
+            result = await with_ratelimit(self.client.join)(room.room_id)
+            if not isinstance(result, JoinError):
+                break
+            logger.error("Unable to join room: %s (attempt %d/%d)", room.room_id, attempt + 1, JOIN_ATTEMPTS)
+            if attempt + 1 < JOIN_ATTEMPTS:
+                await asyncio.sleep(JOIN_RETRY_BASE_DELAY * (2 ** attempt))
+        else:
             return
 
-        logger.info(f"Joined {room.room_id}")
\ No newline at end of file
+        logger.info("Joined %s", room.room_id)
\ No newline at end of file
@@ -1,17 +1,15 @@
 
 from collections import defaultdict
-from enum import Enum
+import functools
 import io
 import logging
-import asyncio
 import os
 import re
 import traceback
-import magic
-from typing import Dict, Iterator, Optional, Union
+from typing import TYPE_CHECKING, Dict, Iterator, Optional, Tuple, Union
 from PIL import Image
 
-from markdown import markdown
+from markdown import Markdown
 from nio import (
     AsyncClient,
     ErrorResponse,
@@ -31,19 +29,54 @@ from nio import (
 
 from nio.crypto import OlmDevice, InboundGroupSession, Session
 
-from bot_messenger.messages import BaseMessage, MediaMessage, MessageType, TextMessage
+from bot_messenger.utils import IMAGE_EXTENSIONS, sniff_mime_type, with_ratelimit
+
+if TYPE_CHECKING:
+    from bot_messenger.messages import BaseMessage # messages imports the send functions of this module
 
 logger = logging.getLogger(__name__)
+
+# Reused for every message, building a Markdown instance loads its extensions each time
+_MARKDOWN = Markdown(output_format="xhtml", extensions=[])
+
+# Characters that can change how a message renders as markdown, or have to be escaped in HTML.
+# Newlines can start a block on any line and tabs are expanded to spaces.
+MARKDOWN_CHARS = "*_`#>[!\\<&-+=|\n\t"
+# Line starts that only matter at the start of a single line message: an indented code block or an ordered list
+_MARKDOWN_START = re.compile(r"\s|\d+\.")
+
+# Content templates of text messages, copied for every message
+_NOTICE_BASE = {"msgtype": "m.notice"}
+_TEXT_BASE = {"msgtype": "m.text"}
+
+MAX_CACHED_MARKDOWN_LENGTH = 4096 # Longer messages are converted without caching, bounding the cache to a few MiB
+
+@functools.lru_cache(maxsize=1024)
+def _cached_markdown_to_html(message: str) -> str:
+    return _MARKDOWN.reset().convert(message)
+
+def markdown_to_html(message: str) -> str:
+    """Convert markdown to HTML, notifications repeat often enough to keep recent short conversions."""
+    if len(message) <= MAX_CACHED_MARKDOWN_LENGTH:
+        return _cached_markdown_to_html(message)
+    return _MARKDOWN.reset().convert(message)
+
+def has_markdown(message: str) -> bool:
+    """Whether markdown would render the message differently from its plain text.
+
+    Multi-line messages always count, as paragraphs, lists and code blocks can start on any line.
+    """
+    return any(c in message for c in MARKDOWN_CHARS) or _MARKDOWN_START.match(message) is not None
+
+@functools.lru_cache(maxsize=None)
+def ratelimited_room_send(client: AsyncClient):
+    """The client's room_send wrapped with rate limit handling, built once per client."""
+    return with_ratelimit(client.room_send)
         
         
 def is_user_in_room(room: MatrixRoom, mxid: str) -> bool:
-    for user in room.users:
-        if user == mxid:
-            return True
-    for user in room.invited_users:
-        if user == mxid:
-            return True
-    return False
+    # Both are dicts keyed by user id
+    return mxid in room.users or mxid in room.invited_users
 
 def is_room_private_msg(room: MatrixRoom, mxid: str) -> bool:
     if room.member_count == 2:
@@ -53,8 +86,7 @@ def is_room_private_msg(room: MatrixRoom, mxid: str) -> bool:
 def find_private_msg(client: AsyncClient, mxid: str) -> Union[MatrixRoom, None]:
     # Find if we already have a common room with user:
     msg_room = None
-    for roomid in client.rooms:
-        room = client.rooms[roomid]
+    for room in client.rooms.values():
         if is_room_private_msg(room, mxid):
             msg_room = room
             break
@@ -66,16 +98,11 @@ def find_private_msg(client: AsyncClient, mxid: str) -> Union[MatrixRoom, None]:
     return msg_room
 
 def is_ready_to_send_message(client: AsyncClient, room_id:str, mxid:str):
-    msg_room = None
-    if room_id in client.rooms:
-        msg_room = client.rooms[room_id]
-    else:
+    msg_room = client.rooms.get(room_id)
+    if msg_room is None:
         return False
     
-    if msg_room.encrypted and mxid in msg_room.users.keys():
-        return True
-    else:
-        return False
+    return msg_room.encrypted and mxid in msg_room.users
 
 async def create_private_room(
     client: AsyncClient, mxid: str, roomname: str
@@ -103,39 +130,15 @@ async def create_private_room(
     if isinstance(resp, RoomCreateResponse):
         logger.debug(f"Created a new DM for user {mxid} with roomID: {resp.room_id}")
     elif isinstance(resp, RoomCreateError):
-        logger.exception(
+        logger.error(
             f"Failed to create a new DM for user {mxid} with error: {resp.status_code}"
         )
     return resp
 
-async def send_message_to_room(client: AsyncClient, message: BaseMessage):
-    # Send the message based on the message type
-    if message.message_type == MessageType.TEXT:
-        textMessage: TextMessage = message
-        content = textMessage.get_content()
-        await send_text_to_room(client, textMessage.recipient_room_id, content)
-    elif message.message_type == MessageType.MEDIA:
-        mediaMessage: MediaMessage = message
-        content = mediaMessage.get_content()
-        msgtype = get_message_type(mediaMessage)
-        
-        if msgtype == "m.image":
-            await send_image(client, mediaMessage.recipient_room_id, content, mediaMessage.message_length_in_bytes, mediaMessage.file_name)   
-        else:
-            await send_file(client, mediaMessage.recipient_room_id, content, mediaMessage.message_length_in_bytes, mediaMessage.file_name)
-    else:
-        logger.warning(f"Message type {message.message_type} not supported")
-
+async def send_message_to_room(client: AsyncClient, message: "BaseMessage"):
+    # Each message type knows how it is sent
+    return await message.send(client)
 
-def get_message_type(message: MediaMessage):
-    if re.match(
-        "^.jpg$|^.jpeg$|^.gif$|^.png$|^.svg$",
-        os.path.splitext(message.file_name)[1].lower(),
-    ):
-        return "m.image"
-    else:
-        return "m.file"
-        
 
 async def send_text_to_room(
     client: AsyncClient,
@@ -167,27 +170,23 @@ async def send_text_to_room(
         A RoomSendResponse if the request was successful, else an ErrorResponse.
     """
     # Determine whether to ping room members or not
-    msgtype = "m.notice" if notice else "m.text"
-
-    content = {
-        "msgtype": msgtype,
-        #"format": "org.matrix.custom.html",
-        "body": message,
-    }
+    content = (_NOTICE_BASE if notice else _TEXT_BASE).copy()
+    content["body"] = message
 
     if message.startswith("<html>"):
         content["format"] = "org.matrix.custom.html"
-        message = message.replace('\n', '')
+        message = message.strip()
         content["formatted_body"] = message
         content["body"] = message
-    elif markdown_convert:
-        content["formatted_body"] = markdown(message)
+    elif markdown_convert and has_markdown(message):
+        # Plain text renders the same without a formatted body
+        content["formatted_body"] = markdown_to_html(message)
 
     if reply_to_event_id:
         content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
 
     try:
-        return await with_ratelimit(client.room_send)(
+        return await ratelimited_room_send(client)(
                     room_id,
                     "m.room.message",
                     content,
@@ -196,39 +195,39 @@ async def send_text_to_room(
     except (SendRetryError, LocalProtocolError):
         logger.exception(f"Unable to send message response to {room_id}")
 
-async def sleep_ms(delay_ms):
-    deadzone = 50  # 50ms additional wait time.
-    delay_s = (delay_ms + deadzone) / 1000
+UPLOAD_CHUNK_SIZE = 4 << 20 # 4 MiB
 
-    await asyncio.sleep(delay_s)
+def upload_data_provider(data: bytes, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Data provider for AsyncClient.upload streaming data in chunks.
 
-def with_ratelimit(func):
-    """
-    Decorator for calling client methods with backoff, specified in server response if rate limited.
+    nio calls the provider again when an upload is retried, which restarts the chunk
+    generator from the beginning. The chunks are memoryview slices sharing the buffer
+    of data, the encryption reads them directly without copying the body first.
     """
-    async def wrapper(*args, **kwargs):
-        while True:
-            logger.debug(f"waiting for response")
-            response = await func(*args, **kwargs)
-            logger.debug(f"Response: {response}")
-            if isinstance(response, ErrorResponse):
-                if response.status_code == "M_LIMIT_EXCEEDED":
-                    await sleep_ms(response.retry_after_ms)
-                else:
-                    return response
-            else:
-                return response
+    def provider(got_429, got_timeouts):
+        view = memoryview(data)
+        return (view[i:i + chunk_size] for i in range(0, len(view), chunk_size))
 
-    return wrapper
+    return provider
 
 
+def get_image_size(data: bytes) -> Tuple[int, int]:
+    """Get the (width, height) of an image.
+
+    Image.open only parses the image header, the pixel data is never decoded as long as
+    the image is not loaded. BytesIO shares the buffer of data instead of copying it.
+    """
+    with Image.open(io.BytesIO(data)) as im:
+        return im.size
+
 
 # Adapted methods from https://github.com/8go/matrix-commander/blob/master/matrix_commander/matrix_commander.py
 async def send_file(client,     
         room_id: str,
         data: bytes,
         file_size: int,
-        file_name: str
+        file_name: str,
+        mime_type: Optional[str] = None,
 )-> Union[RoomSendResponse, ErrorResponse]:
     """Process file.
 
@@ -284,7 +283,8 @@ async def send_file(client,
     #    return
 
     # 'application/pdf' "plain/text" "audio/ogg"
-    mime_type = magic.from_buffer(data, mime=True)
+    if mime_type is None:
+        mime_type = sniff_mime_type(data)
     # if ((not mime_type.startswith("application/")) and
     #        (not mime_type.startswith("plain/")) and
     #        (not mime_type.startswith("audio/"))):
@@ -299,7 +299,7 @@ async def send_file(client,
     # then send URI of upload to room
 
     resp, decryption_keys = await client.upload(
-        io.BytesIO(data),
+        upload_data_provider(data),
         content_type=mime_type,  # application/pdf
         filename=file_name,
         filesize=file_size,
@@ -339,17 +339,11 @@ async def send_file(client,
             "mimetype": mime_type
         },
         "msgtype": msg_type,
-        "file": {
-            "url": resp.content_uri,
-            "key": decryption_keys["key"],
-            "iv": decryption_keys["iv"],
-            "hashes": decryption_keys["hashes"],
-            "v": decryption_keys["v"],
-        },
+        "file": {**decryption_keys, "url": resp.content_uri}, # key, iv, hashes and v
     }
 
     try:
-        resp = await with_ratelimit(client.room_send)(
+        resp = await ratelimited_room_send(client)(
             room_id,
             message_type="m.room.message",
             content=content,
@@ -379,7 +373,8 @@ async def send_image(client,
         room_id: str,
         data: bytes,
         file_size: int,
-        file_name: str):
+        file_name: str,
+        mime_type: Optional[str] = None):
     """Process image.
 
     Arguments:
@@ -429,21 +424,20 @@ async def send_image(client,
     # "tiff", "webp", "svg",
 
     # svg files are not shown in Element, hence send SVG files as files with -f
-    if not re.match(
-        "^.jpg$|^.jpeg$|^.gif$|^.png$|^.svg$",
-        os.path.splitext(file_name)[1].lower(),
-    ):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in IMAGE_EXTENSIONS:
         logger.warning(
             f"Image file {file_name} is not an image file. Should be "
             ".jpg, .jpeg, .gif, or .png. "
-            f"Found [{os.path.splitext(file_name)[1].lower()}]. "
+            f"Found [{extension}]. "
             "This image is being dropped and NOT sent."
         )
         return
 
     # 'application/pdf' "image/jpeg"
     # svg mime-type is "image/svg+xml"
-    mime_type = magic.from_buffer(data, mime=True)
+    if mime_type is None:
+        mime_type = sniff_mime_type(data)
 
     logger.debug(f"Image file mime-type is {mime_type}")
     if not mime_type.startswith("image/"):
@@ -467,8 +461,7 @@ async def send_image(client,
         blurhash = "ULH_C:0HGF}B.$k:PLVG8z}$4;o?~IQ:9$yB"
         blurhash = None  # shows turning circle forever in Element due to bug
     else:
-        im = Image.open(io.BytesIO(data))  # this will fail for SVG files
-        (width, height) = im.size  # im.size returns (width,height) tuple
+        (width, height) = get_image_size(data)  # this will fail for SVG files
         blurhash = None
 
     # first do an upload of image, see upload() documentation
@@ -479,7 +472,7 @@ async def send_image(client,
     # treatment is required.
 
     resp, decryption_keys = await client.upload(
-        io.BytesIO(data),
+        upload_data_provider(data),
         content_type=mime_type,  # image/jpeg
         filename=file_name,
         filesize=file_size,
@@ -520,17 +513,11 @@ async def send_image(client,
             # "thumbnail_file": None,
         },
         "msgtype": "m.image",
-        "file": {
-            "url": resp.content_uri,
-            "key": decryption_keys["key"],
-            "iv": decryption_keys["iv"],
-            "hashes": decryption_keys["hashes"],
-            "v": decryption_keys["v"],
-        },
+        "file": {**decryption_keys, "url": resp.content_uri}, # key, iv, hashes and v
     }
 
     try:
-        resp = await with_ratelimit(client.room_send)(
+        resp = await ratelimited_room_send(client)(
             room_id,
             message_type="m.room.message",
             content=content,
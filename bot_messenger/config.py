@@ -113,6 +113,9 @@ class Config:
         self.certFilePath = self._get_cfg(["cert_file_path"], default="./data/server.pem")
         self.enableSSL = self._get_cfg(["enable_ssl"], default=False)
         self.api_key = self._get_cfg(["API_key"], required=True)
+        self.callback_workers = self._get_cfg(["callback_workers"], default=64)
+        if not isinstance(self.callback_workers, int) or self.callback_workers < 1:
+            raise ConfigError("callback_workers must be a positive integer")
 
 
 
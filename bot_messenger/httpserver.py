@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 import asyncio
-from threading import Thread
+import hmac
 import logging
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import signal
 import ssl
 import sys
 
-from bot_messenger.messages import BaseMessage, MediaMessage, TextMessage
+from aiohttp import web
+
+from bot_messenger.messages import BaseMessage, MediaMessage, TextMessage, message_pool
 
 """
 A HTTP server for listening to POST requests and relaying the messages to a Matrix bot.
@@ -33,114 +35,146 @@ async def sample_callback(msg):
 MESSAGE_CALLBACK = sample_callback
 NOTIFICATIONS_ROOM_ID = None
 API_KEY = "apiKey"
-EVENT_LOOP = None
-
-class httpRequestHandler(BaseHTTPRequestHandler):
+MAX_BODY_SIZE = 50 << 20 # 50 MiB, media messages can be large
+CALLBACK_WORKERS = 64 # Messages handed to MESSAGE_CALLBACK concurrently
+MESSAGE_QUEUE: asyncio.Queue = None # Accepted messages waiting for a callback worker
+MAX_QUEUED_MESSAGES = 256 # Further messages are refused with 503 until the workers catch up
+LOGGED_BODY_SIZE = 256 # Bytes of a request body included in debug logs
+
+# Response bodies that don't depend on the request, encoded once
+ACCEPTED_RESPONSE_BODY = b"POST request was Successfull!"
+EMPTY_RESPONSE_BODY = b"POST request data was empty or contentType was wrong."
+BUSY_RESPONSE_BODY = b"Too many messages waiting to be sent, retry later."
+
+async def handle_post(request: web.Request) -> web.Response:
     # Define Post request response
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length']) # <--- Gets the size of data
-        post_data = self.rfile.read(content_length) # <--- Gets the data itself
-        contentType = str(self.headers.get("Content-Type")).split(';') # <--- get type of post request body
-        api_key = str(self.headers.get("Api-Key-Here")).split(';')[0]  # <--- get api key
-        sendTo = self.headers.get('Send-To')# <--- get room/user to send message to
-        
-        if sendTo is None and NOTIFICATIONS_ROOM_ID is not None:
-            sendTo = NOTIFICATIONS_ROOM_ID
-            
-        logger.debug(f"POST request, data: {post_data}, optional headers: {sendTo}")
-       # print("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
-      #          str(self.path), str(self.headers), post_data.decode('utf-8'))
-      #  print("###########################\n")
-
-        #post_data.decode('utf-8') # convert post body data into string
-        
-        # We will parse POST requests with body formats of multipart/form-data with name="Message" ; text/plain sends text ; other types are sent as media.
-        if api_key == API_KEY:
-            message = None
-            if contentType[0] == "multipart/form-data":
-                boundary = contentType[1].split('=') # parse multipart/form-data boundary string
-                data = self.parsePostData(post_data.decode('utf-8'),boundary[1]).encode('utf-8') #parse post request data manually
-                message = TextMessage(sendTo, data, content_length)
-            elif contentType[0].startswith("text/"):
-                #msg = post_data.decode('utf-8')
-                message = TextMessage(sendTo, post_data, content_length)
-            else:
-                file_name = self.headers.get("File-Name")
-                message = MediaMessage(sendTo, post_data, content_length, contentType, file_name)
-
-            self.initiate_callback(message) # initiate callback
-
-    def initiate_callback(self, message: BaseMessage):
-        if message is None:
-            self._set_response(400)
-            self.wfile.write("POST request data was empty or contentType was wrong.".encode('utf-8'))
-        elif message.is_valid:
-            self._set_response(200)
-            self.wfile.write(f"POST request for {self.path} was Successfull!".encode('utf-8'))
-            logger.debug(f"Calling callback with message: {message}")
-            EVENT_LOOP.create_task(MESSAGE_CALLBACK(message)) # Send the message to all subscribed chat groups
-        else:
-            self._set_response(400)
-            self.wfile.write(f"POST request for {self.path} FAILED with error: {message}".encode('utf-8'))
-            
-    def parsePostData(self, data, boundary):
-        data = str(data).split("--"+boundary+'\r\n')[1:] # Separate body data into fields with string manipulation.
-        for i in range(len(data)):
-            # Find field name
-            start = data[i].find('name="')+6
-            end = data[i][start+6:].find('"')+6
-            name = data[i][start:end+start]
-            # Get text content of the field
-            body = data[i][end+start+5:]
-            # Clean up text of remaining boundary strings
-            body = body.replace("\r\n--"+boundary+"--","")
-            # if field name matches key return the text content
-            if name=="Message":
-                return body[:-2]
-        return ""
-    
-    def _set_response(self, code):
-        self.send_response(code)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
+    content_length = request.content_length # <--- Gets the size of data
+    api_key = (request.headers.get("Api-Key-Here") or "").partition(';')[0]  # <--- get api key
+
+    # Reject unauthorized and oversized requests before reading any of the body
+    # compare_digest takes the same time wherever the keys differ, so the key can't be guessed from response times
+    if not hmac.compare_digest(api_key.encode('utf-8'), API_KEY.encode('utf-8')):
+        return web.Response(status=401, content_type='text/html')
+    if content_length is not None and content_length > MAX_BODY_SIZE:
+        return web.Response(status=413, content_type='text/html', text=f"POST request body exceeds {MAX_BODY_SIZE} bytes.")
+
+    contentType = request.content_type # <--- get type of post request body, parsed once by aiohttp without its parameters
+    sendTo = request.headers.get('Send-To')# <--- get room/user to send message to
+
+    if sendTo is None and NOTIFICATIONS_ROOM_ID is not None:
+        sendTo = NOTIFICATIONS_ROOM_ID
+
+    # We will parse POST requests with body formats of multipart/form-data with name="Message" ; text/plain sends text ; other types are sent as media.
+    message = None
+    # Message lengths are taken from the data read, Content-Length is missing for chunked requests and covers all form fields
+    if contentType == "multipart/form-data":
+        try:
+            data = await read_form_field(request, "Message") # parse multipart/form-data fields
+        except ValueError as e:
+            logger.debug("Malformed multipart/form-data body: %s", e)
+            return web.Response(status=400, content_type='text/html', body=EMPTY_RESPONSE_BODY)
+        logger.debug("POST request, data: %r, optional headers: %s", data[:LOGGED_BODY_SIZE], sendTo)
+        if data:
+            message = message_pool.acquire(TextMessage, sendTo, data, len(data))
+    else:
+        post_data = await request.read() # <--- Gets the data itself
+        logger.debug("POST request, data: %r, optional headers: %s", post_data[:LOGGED_BODY_SIZE], sendTo)
+        if post_data and contentType.startswith("text/"):
+            message = message_pool.acquire(TextMessage, sendTo, post_data, len(post_data))
+        elif post_data:
+            file_name = request.headers.get("File-Name")
+            message = message_pool.acquire(MediaMessage, sendTo, post_data, len(post_data), contentType, file_name)
+
+    return await initiate_callback(request, message) # initiate callback
+
+async def read_form_field(request: web.Request, name: str) -> bytes:
+    """Read the raw bytes of a multipart/form-data field in a single pass over the body, skipping other fields.
+
+    The multipart reader does not enforce the body size limit, so the field is read in chunks
+    and the request is refused with 413 once it grows past MAX_BODY_SIZE.
+
+    Raises:
+        ValueError: The body has a missing or malformed multipart boundary.
+    """
+    reader = await request.multipart()
+    async for part in reader:
+        if part.name == name:
+            data = bytearray()
+            while True:
+                chunk = await part.read_chunk()
+                if not chunk:
+                    return bytes(data)
+                data += chunk
+                if len(data) > MAX_BODY_SIZE:
+                    raise web.HTTPRequestEntityTooLarge(MAX_BODY_SIZE, len(data))
+    return b""
+
+async def initiate_callback(request: web.Request, message: BaseMessage) -> web.Response:
+    if message is None:
+        return web.Response(status=400, content_type='text/html', body=EMPTY_RESPONSE_BODY)
+    elif message.is_valid:
+        logger.debug("Queueing callback with message: %s", message)
+        try:
+            MESSAGE_QUEUE.put_nowait(message) # Send the message to all subscribed chat groups
+        except asyncio.QueueFull:
+            logger.warning("Message queue is full, refusing message: %s", message)
+            message_pool.release(message)
+            return web.Response(status=503, content_type='text/html', body=BUSY_RESPONSE_BODY, headers={"Retry-After": "1"})
+        return web.Response(status=202, content_type='text/html', body=ACCEPTED_RESPONSE_BODY)
+    else:
+        response = web.Response(status=400, content_type='text/html', text=f"POST request for {request.path} FAILED with error: {message}")
+        message_pool.release(message)
+        return response
+
+async def callbackWorker(queue: asyncio.Queue):
+    # Relay accepted messages to the callback, independently of the request that posted them
+    while True:
+        message = await queue.get()
+        try:
+            await MESSAGE_CALLBACK(message)
+        except Exception:
+            logger.exception("Message callback failed for message: %s", message)
+        finally:
+            queue.task_done()
+
+def create_app() -> web.Application:
+    """Create the web application that accepts notifications on any path."""
+    app = web.Application(client_max_size=MAX_BODY_SIZE)
+    app.router.add_post('/{tail:.*}', handle_post)
+    return app
 
 class HttpServerInstance():
-    def __init__(self, loop, port=8080, certFilePath='./data/server.pem', enableSSL = False):
-        global EVENT_LOOP
-        EVENT_LOOP = loop
+    def __init__(self, port=8080, certFilePath='./data/server.pem', enableSSL = False):
         self.port = port
         self.certFilePath = certFilePath
         self.enableSSL = enableSSL
+        self.runner = None
+        self.workers = []
 
-    def runHttpServer(self, httpd):
-        try:
-            httpd.serve_forever()
-        except:
-            pass
-
+    async def run(self):
+        global MESSAGE_QUEUE
+        MESSAGE_QUEUE = asyncio.Queue(maxsize=MAX_QUEUED_MESSAGES)
+        self.workers = [asyncio.create_task(callbackWorker(MESSAGE_QUEUE)) for _ in range(CALLBACK_WORKERS)]
 
-    def run(self):
-        server_address = ('', self.port)
-        # Create a http server instance and run it in a separate thread.
-        self.httpd = HTTPServer(server_address, httpRequestHandler)
+        # Create the http server on the running event loop, sharing it with the Matrix client.
+        app = create_app()
         #setting up ssl sertification
+        ssl_context = None
         if self.enableSSL:
-            self.httpd.socket = ssl.wrap_socket (self.httpd.socket, certfile=self.certFilePath, server_side=True)
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(self.certFilePath)
         logger.info('Starting httpd...')
-        try:
-            self.thread = Thread(target= self.runHttpServer, args=(self.httpd,))
-            self.thread.start()
-        except KeyboardInterrupt: # On Exit we close the http server.
-            logger.info("Received keyboard interrupt, stopping.")
-            self.stop()
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '', int(self.port), ssl_context=ssl_context).start()
 
-    def stop(self):
+    async def stop(self):
         logger.info('Stopping httpd...')
-        self.httpd.server_close()
-        self.httpd.shutdown()
+        if self.runner is not None:
+            await self.runner.cleanup()
+        for worker in self.workers:
+            worker.cancel()
         logger.info("HTTPD Server stopped.")
-        self.thread.join() # does not stop??
-        logger.info("HTTPD server polling thread joined")
 
         #Stopping parent process
         sys.exit(0)
@@ -156,23 +190,31 @@ class HttpServerInstance():
     def set_notifications_room_id(self, room_id:str):
         global NOTIFICATIONS_ROOM_ID
         NOTIFICATIONS_ROOM_ID = room_id
+        
+    def set_callback_workers(self, workers:int):
+        # Takes effect on the next run()
+        global CALLBACK_WORKERS
+        CALLBACK_WORKERS = workers
     
 async def mainLoop():
-    while(True):
-        try:
-            await asyncio.sleep(1)
-        except KeyboardInterrupt: # On Exit we close the http server.
-            logger.info("Exception: Received keyboard interrupt, stopping.")
-            break
+    # Sleep until asked to stop instead of waking up periodically
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, shutdown.set)
+    await shutdown.wait()
+    logger.info("Received shutdown signal, stopping.")
+
+async def runStandalone(httpServerInstance):
+    await httpServerInstance.run()
+    await mainLoop()
+    await httpServerInstance.stop() # On Exit we close the http server.
 
 if __name__ == '__main__':
     from sys import argv
-    EVENT_LOOP
-    EVENT_LOOP = asyncio.get_event_loop()
     if len(argv) == 2:
         httpServerInstance = HttpServerInstance(int(argv[1]))
          # Set a custom port ex: ./server.py 5665
     else:
         httpServerInstance = HttpServerInstance()
-    httpServerInstance.run()
-    EVENT_LOOP.run_until_complete(mainLoop())
+    asyncio.run(runStandalone(httpServerInstance))
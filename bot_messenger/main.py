@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import asyncio
 import logging
 import sys
 from time import sleep
@@ -14,6 +13,7 @@ from nio import (
     LoginError,
     RoomEncryptionEvent,
     RoomMemberEvent,
+    SyncResponse,
 )
 
 from bot_messenger.callbacks import Callbacks
@@ -66,17 +66,19 @@ async def main():
     # Set up event callbacks
     callbacks = Callbacks(client, store, config)
     # Start the HTTP server
-    httpServerInstance = HttpServerInstance(asyncio.get_event_loop(), config.port, config.certFilePath, config.enableSSL)
+    httpServerInstance = HttpServerInstance(config.port, config.certFilePath, config.enableSSL)
     httpServerInstance.set_callback(callbacks.notification)
     httpServerInstance.set_api_key(config.api_key)
+    httpServerInstance.set_callback_workers(config.callback_workers)
     if config.send_to_notifications_room_by_default:
         httpServerInstance.set_notifications_room_id(config.notifications_room)
-    httpServerInstance.run()
+    await httpServerInstance.run()
 
     #client.add_event_callback(callbacks.message, (RoomMessageText,))
     client.add_event_callback(callbacks.member, (RoomMemberEvent,))
     client.add_event_callback(callbacks.room_encryption, (RoomEncryptionEvent,))
     client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
+    client.add_response_callback(callbacks.sync, (SyncResponse,))
 
     # Keep trying to reconnect on failure (with some time in-between)
     while True:
@@ -97,7 +99,7 @@ async def main():
                     )
 
                     # Check if login failed
-                    if type(login_response) == LoginError:
+                    if isinstance(login_response, LoginError):
                         logger.error("Failed to login: %s", login_response.message)
                         return False
                 except LocalProtocolError as e:
@@ -131,9 +133,6 @@ async def main():
             # Make sure to close the client connection on disconnect
             await client.close()
             # Make sure to close the http server on disconnect
-            httpServerInstance.stop()
+            await httpServerInstance.stop()
             logger.info('Closed client and http server')
 
-
-# Run the main function in an asyncio event loop
-asyncio.get_event_loop().run_until_complete(main())
@@ -1,14 +1,22 @@
-from enum import Enum
+from collections import deque
+from enum import IntEnum
+import logging
 import os
 import re
 
-import magic
-
 from nio import (
     AsyncClient,
 )
 
-class MessageType(Enum):
+from bot_messenger.chat_functions import send_file, send_image, send_text_to_room
+from bot_messenger.utils import IMAGE_EXTENSIONS, sniff_mime_type
+
+logger = logging.getLogger(__name__)
+
+_USER_ID_RE = re.compile(r"@[^:]+:.+")
+_ROOM_ID_RE = re.compile(r"![^:]+:.+")
+
+class MessageType(IntEnum):
     BASE = 0
     TEXT = 1
     MEDIA = 2
@@ -41,13 +49,17 @@ class BaseMessage():
             self.invalidate_message(f"Recipient not provided, must be one of @user:server.com or !roomid:server.com in '-H \"Send-To: @user:server.com\"'" % self.message_to)
             return
         
-        if re.match("@.*:.*", self.message_to):
+        if _USER_ID_RE.match(self.message_to):
             self.recipient_user_id = self.message_to
-        elif re.match("!.*:.*", self.message_to):
+        elif _ROOM_ID_RE.match(self.message_to):
             self.recipient_room_id = self.message_to
         else:
             self.invalidate_message(f"Invalid recipient: %s. Must be one of @user:server.com or !roomid:server.com" % self.message_to)
        
+    def reset(self):
+        # Drop all instance state so the class level defaults apply again
+        vars(self).clear()
+
     def invalidate_message(self, reason:str):
         self.is_valid = False
         self.invalidation_reason = reason
@@ -60,29 +72,44 @@ class BaseMessage():
     
     def get_content(self):
         
-        if self.message_type == MessageType.TEXT:
+        if self.message_type is MessageType.TEXT:
             return self.data.decode('utf-8')
         
-        if self.message_type == MessageType.MEDIA:
+        if self.message_type is MessageType.MEDIA:
             return self.data
         
         return f"Message type {self.message_type} not implemented!"
 
+    async def send(self, client:AsyncClient):
+        """Send the message to its recipient room.
+
+        Args:
+            client: The client to communicate to matrix with.
+        """
+        logger.warning("Message type %s not supported", self.message_type)
+
 class TextMessage(BaseMessage):   
     message_type: MessageType = MessageType.TEXT
     
+    _text: str = None # Decoded data, filled in on first use
+    
     def __init__(self, message_to:str, data:bytes, message_length_in_bytes:int):
         super().__init__(message_to, data, message_length_in_bytes)
         self.validate_decodable_text()
         
     def validate_decodable_text(self):
         try:
-            self.data.decode('utf-8')
+            self._text = self.data.decode('utf-8')
         except Exception as e:
             self.invalidate_message(str(e))
     
     def get_content(self):
-        return self.data.decode('utf-8')
+        if self._text is None:
+            self._text = self.data.decode('utf-8')
+        return self._text
+    
+    async def send(self, client:AsyncClient):
+        return await send_text_to_room(client, self.recipient_room_id, self.get_content())
     
     def __str__(self):
         if not self.is_valid:
@@ -95,6 +122,8 @@ class MediaMessage(BaseMessage):
     
     contentType: str
     file_name: str
+    msgtype: str = None # Matrix message type, m.image or m.file
+    mime_type: str = None
     
     def __init__(self, message_to:str, data:bytes, message_length_in_bytes:int, content_type:str, file_name:str):
         super().__init__(message_to, data, message_length_in_bytes)
@@ -112,8 +141,9 @@ class MediaMessage(BaseMessage):
             self.invalidate_message(f"File extension missing in {self.file_name}")
             return
         
-        mime_type = magic.from_buffer(self.data, mime=True)
-        if re.match("^.jpg$|^.jpeg$|^.gif$|^.png$|^.svg$", os.path.splitext(self.file_name)[1].lower()):
+        self.mime_type = mime_type = sniff_mime_type(self.data)
+        self.msgtype = "m.image" if extension in IMAGE_EXTENSIONS else "m.file"
+        if self.msgtype == "m.image":
             if not mime_type.startswith("image/"):
                 self.invalidate_message(
                     f"Image file {self.file_name} does not have an image mime type. "
@@ -124,8 +154,55 @@ class MediaMessage(BaseMessage):
     def get_content(self):
         return self.data
     
+    async def send(self, client:AsyncClient):
+        send = send_image if self.msgtype == "m.image" else send_file
+        return await send(client, self.recipient_room_id, self.data, self.message_length_in_bytes, self.file_name, self.mime_type)
+    
     def __str__(self):
         if not self.is_valid:
             return self.invalidation_reason
 
-        return f"{super().__str__()}, file_name: {self.file_name}"
\ No newline at end of file
+        return f"{super().__str__()}, file_name: {self.file_name}"
+
+class BaseMessagePool():
+    """Recycles message instances to avoid allocating a new object for every notification.
+
+    A released message is reset and handed out again by a later acquire, so it must not
+    be used or retained by the caller after release().
+    """
+
+    def __init__(self, maxsize:int = 64):
+        """
+        Args:
+            maxsize: Maximum number of free instances kept per message class.
+        """
+        self.maxsize = maxsize
+        self._free: dict[type, deque[BaseMessage]] = {}
+
+    def acquire(self, message_class:type, *args) -> BaseMessage:
+        """Get an initialised message of the given class, reusing a released one if available.
+
+        Args:
+            message_class: The BaseMessage subclass to get.
+
+            args: Constructor arguments of message_class.
+        """
+        free = self._free.get(message_class)
+        if free:
+            message = free.pop()
+            message.__init__(*args)
+            return message
+        return message_class(*args)
+
+    def release(self, message:BaseMessage):
+        """Return a message to the pool once it is no longer needed.
+
+        Args:
+            message: The message to recycle.
+        """
+        free = self._free.setdefault(type(message), deque())
+        if len(free) < self.maxsize:
+            message.reset()
+            free.append(message)
+
+message_pool = BaseMessagePool()
@@ -0,0 +1,135 @@
+import itertools
+from collections import deque
+from typing import List, Optional
+
+from bot_messenger.messages import BaseMessage
+
+MAX_PENDING_MESSAGES = 10000 # Messages kept across all rooms
+MAX_PENDING_ROOM_MESSAGES = 1000 # Messages kept for a single room
+
+
+class PendingRoom:
+    """The messages waiting for a single room, along with the user they are addressed to."""
+
+    def __init__(self, owner_user_id: str):
+        """
+        Args:
+            owner_user_id: The recipient the room was resolved or created for.
+        """
+        self.owner_user_id = owner_user_id
+        self.messages: deque[tuple[int, BaseMessage]] = deque() # In arrival order (sequence number, message)
+
+
+class PendingStore:
+    """Messages waiting for their room to become ready before being sent.
+
+    Memory is bounded by a global and a per-room limit. Once a limit is exceeded, the
+    oldest messages are dropped - a room that never becomes ready (stuck invite, offline
+    recipient) can not grow the store indefinitely.
+
+    Every message gets a sequence number, and the arrival order across rooms is kept as
+    (sequence number, room id) entries. Entries of messages that already left their room
+    are not searched for but skipped once reached, and compacted away once they make up
+    more than half of the order.
+    """
+
+    def __init__(self, max_messages: int = MAX_PENDING_MESSAGES, max_room_messages: int = MAX_PENDING_ROOM_MESSAGES):
+        """
+        Args:
+            max_messages: Maximum number of messages kept across all rooms.
+
+            max_room_messages: Maximum number of messages kept for a single room.
+        """
+        self.max_messages = max_messages
+        self.max_room_messages = max_room_messages
+
+        self._order: deque[tuple[int, str]] = deque() # Arrival order across all rooms (sequence number, room_id), may hold stale entries
+        self._by_room: dict[str, PendingRoom] = {} # (room_id : pending room)
+        self._size = 0 # Messages stored across all rooms
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, room_id: str) -> bool:
+        return room_id in self._by_room
+
+    def owner(self, room_id: str) -> Optional[str]:
+        """Get the user the pending messages of a room are addressed to, if any are pending.
+
+        Args:
+            room_id: The room to look up.
+        """
+        pending_room = self._by_room.get(room_id)
+        return pending_room.owner_user_id if pending_room is not None else None
+
+    def append(self, room_id: str, owner_user_id: str, message: BaseMessage) -> List[BaseMessage]:
+        """Store a message until its room becomes ready.
+
+        Args:
+            room_id: The room the message is addressed to.
+
+            owner_user_id: The user the room was resolved or created for.
+
+            message: The message to store.
+
+        Returns:
+            The messages dropped to stay within the limits, oldest first.
+        """
+        dropped = []
+
+        pending_room = self._by_room.get(room_id)
+        if pending_room is None:
+            pending_room = self._by_room[room_id] = PendingRoom(owner_user_id)
+        elif len(pending_room.messages) >= self.max_room_messages:
+            # Its entry in the order goes stale and is skipped later
+            dropped.append(pending_room.messages.popleft()[1])
+            self._size -= 1
+
+        sequence = next(self._sequence)
+        pending_room.messages.append((sequence, message))
+        self._order.append((sequence, room_id))
+        self._size += 1
+
+        while self._size > self.max_messages:
+            sequence, oldest_room_id = self._order.popleft()
+            if not self._is_stored(sequence, oldest_room_id):
+                continue
+            oldest_room = self._by_room[oldest_room_id]
+            dropped.append(oldest_room.messages.popleft()[1])
+            self._size -= 1
+            if not oldest_room.messages:
+                del self._by_room[oldest_room_id]
+
+        if len(self._order) > 2 * self.max_messages:
+            self._order = deque(entry for entry in self._order if self._is_stored(*entry))
+
+        return dropped
+
+    def drain(self, room_id: str) -> List[BaseMessage]:
+        """Remove and return all messages stored for a room, oldest first.
+
+        Args:
+            room_id: The room to drain.
+        """
+        pending_room = self._by_room.pop(room_id, None)
+        if pending_room is None:
+            return []
+
+        # The room's entries in the order go stale and are skipped later
+        self._size -= len(pending_room.messages)
+        return [message for _, message in pending_room.messages]
+
+    def _is_stored(self, sequence: int, room_id: str) -> bool:
+        """Whether an entry of the arrival order still refers to a stored message.
+
+        A room's messages only ever leave from its front or all at once, so an entry is
+        stored exactly when its room is stored and has not moved past its sequence number.
+
+        Args:
+            sequence: The sequence number of the entry.
+
+            room_id: The room of the entry.
+        """
+        pending_room = self._by_room.get(room_id)
+        return pending_room is not None and sequence >= pending_room.messages[0][0]
@@ -1,30 +1,59 @@
 import asyncio
+import random
 import nio
 import logging
 
+import magic
+
 logger = logging.getLogger(__name__)
 
-async def sleep_ms(delay_ms):
-    deadzone = 50  # 50ms additional wait time.
-    delay_s = (delay_ms + deadzone) / 1000
+# File extensions sent as m.image messages
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".gif", ".png", ".svg"})
+
+# libmagic only needs the start of a file to detect its type
+MIME_SNIFF_SIZE = 4096
+_MAGIC = magic.Magic(mime=True)
+
+def sniff_mime_type(data:bytes) -> str:
+    return _MAGIC.from_buffer(data[:MIME_SNIFF_SIZE])
+
+# Backoff policy for rate limited requests
+RATELIMIT_BASE_DELAY = 1.0 # Seconds, doubled on every retry
+RATELIMIT_MAX_DELAY = 30.0 # Seconds, unless the server asks for a longer wait
+RATELIMIT_JITTER = 0.5 # Up to 50% random extra delay, decorrelates concurrent senders
+RATELIMIT_MAX_RETRIES = 3
 
-    await asyncio.sleep(delay_s)
-    
-def with_ratelimit(func):
+def ratelimit_delay(retry_after_ms, attempt:int) -> float:
+    """Seconds to wait before retrying a rate limited request.
+
+    Exponential backoff with jitter, capped at RATELIMIT_MAX_DELAY but never shorter than the
+    wait requested by the server.
+    """
+    retry_after = (retry_after_ms or 0) / 1000
+    delay = max(retry_after, RATELIMIT_BASE_DELAY * 2 ** attempt)
+    delay *= 1 + random.uniform(0, RATELIMIT_JITTER)
+    return max(min(delay, RATELIMIT_MAX_DELAY), retry_after)
+
+def with_ratelimit(func, max_retries:int = RATELIMIT_MAX_RETRIES):
     """
-    Decorator for calling client methods with backoff, specified in server response if rate limited.
+    Decorator for calling client methods with backoff if rate limited.
+    Gives up and returns the rate limit error after max_retries retries.
     """
     async def wrapper(*args, **kwargs):
+        attempt = 0
         while True:
-            logger.debug(f"waiting for response")
+            logger.debug("waiting for response")
             response = await func(*args, **kwargs)
-            logger.debug(f"Response: {response}")
-            if isinstance(response, nio.ErrorResponse):
-                if response.status_code == "M_LIMIT_EXCEEDED":
-                    await sleep_ms(response.retry_after_ms)
-                else:
-                    return response
-            else:
+            logger.debug("Response: %s", response)
+            if not (
+                isinstance(response, nio.ErrorResponse)
+                and response.status_code == "M_LIMIT_EXCEEDED"
+            ):
+                return response
+            if attempt >= max_retries:
+                logger.warning("Still rate limited after %d retries, giving up: %s", max_retries, response)
                 return response
+            await asyncio.sleep(ratelimit_delay(response.retry_after_ms, attempt))
+            attempt += 1
 
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -5,6 +5,6 @@ try:
     from bot_messenger import main
 
     # Run the main function of the bot
-    asyncio.get_event_loop().run_until_complete(main.main())
+    asyncio.run(main.main())
 except ImportError as e:
     print("Unable to import bot-messenger.main:", e)
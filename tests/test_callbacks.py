@@ -1,9 +1,17 @@
+import asyncio
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock, call, patch
 
 import nio
 
-from bot_messenger.callbacks import Callbacks
+from bot_messenger.callbacks import (
+    DUPLICATES_CACHE_SIZE,
+    JOIN_ATTEMPTS,
+    MAX_COALESCED_SIZE,
+    Callbacks,
+    encoded_size,
+)
+from bot_messenger.messages import MediaMessage, TextMessage
 from bot_messenger.storage import Storage
 
 from tests.utils import make_awaitable, run_coroutine
@@ -11,6 +19,9 @@ from tests.utils import make_awaitable, run_coroutine
 
 class CallbacksTestCase(unittest.TestCase):
     def setUp(self) -> None:
+        # run_coroutine closes the event loop it used, so give each test a fresh one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
         # Create a Callbacks object and give it some Mock'd objects to use
         self.fake_client = Mock(spec=nio.AsyncClient)
         self.fake_client.user = "@fake_user:example.com"
@@ -19,6 +30,7 @@ class CallbacksTestCase(unittest.TestCase):
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
+        self.fake_config.callback_workers = 64
 
         self.callbacks = Callbacks(
             self.fake_client, self.fake_storage, self.fake_config
@@ -35,6 +47,7 @@ class CallbacksTestCase(unittest.TestCase):
 
         fake_invite_event = Mock(spec=nio.InviteMemberEvent)
         fake_invite_event.sender = "@some_other_fake_user:example.com"
+        fake_invite_event.source = {"event_id": "$fake_invite_event"}
 
         # Pretend that attempting to join a room is always successful
         self.fake_client.join.return_value = make_awaitable(None)
@@ -45,6 +58,240 @@ class CallbacksTestCase(unittest.TestCase):
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+    def test_invite_retries_failed_join(self):
+        """Tests that a failed join is retried before giving up"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+
+        fake_invite_event = Mock(spec=nio.InviteMemberEvent)
+        fake_invite_event.sender = "@some_other_fake_user:example.com"
+        fake_invite_event.source = {"event_id": "$fake_invite_event"}
+
+        # Pretend that attempting to join a room always fails
+        self.fake_client.join.return_value = nio.JoinError("Internal server error")
+
+        with patch("bot_messenger.callbacks.JOIN_RETRY_BASE_DELAY", 0):
+            run_coroutine(self.callbacks.invite(fake_room, fake_invite_event))
+
+        self.assertEqual(self.fake_client.join.call_count, JOIN_ATTEMPTS)
+
+    def test_should_process(self):
+        """Tests that duplicate events are skipped and old ones are evicted"""
+        self.assertTrue(self.callbacks.should_process("$event"))
+        self.assertFalse(self.callbacks.should_process("$event"))
+
+        # Push the first event out of the duplicates cache
+        for i in range(DUPLICATES_CACHE_SIZE):
+            self.assertTrue(self.callbacks.should_process(f"$other_event_{i}"))
+
+        self.assertTrue(self.callbacks.should_process("$event"))
+        self.assertEqual(
+            len(self.callbacks.received_events_set), DUPLICATES_CACHE_SIZE
+        )
+
+    def test_private_room_index(self):
+        """Tests that private rooms are tracked from membership events"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.member_count = 2
+        self.fake_client.rooms = {fake_room.room_id: fake_room}
+
+        fake_member_event = Mock(spec=nio.RoomMemberEvent)
+        fake_member_event.event_id = "$fake_join_event"
+        fake_member_event.state_key = "@some_other_fake_user:example.com"
+        fake_member_event.membership = "join"
+
+        run_coroutine(self.callbacks.member(fake_room, fake_member_event))
+        self.assertEqual(
+            self.callbacks._find_private_room_id(fake_member_event.state_key),
+            fake_room.room_id,
+        )
+
+        # Once the user leaves, the room is no longer their private room
+        fake_member_event.event_id = "$fake_leave_event"
+        fake_member_event.membership = "leave"
+        fake_room.member_count = 1
+        self.fake_client.rooms = {}
+
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        run_coroutine(self.callbacks.member(fake_room, fake_member_event))
+        self.assertIsNone(
+            self.callbacks._find_private_room_id(fake_member_event.state_key)
+        )
+
+    def test_index_private_rooms(self):
+        """Tests that the private room index is built from the rooms known after the first sync"""
+        private_room = Mock(spec=nio.MatrixRoom)
+        private_room.room_id = "!private:example.com"
+        private_room.member_count = 2
+        private_room.users = {self.fake_client.user: None}
+        private_room.invited_users = {"@invited_user:example.com": None}
+
+        group_room = Mock(spec=nio.MatrixRoom)
+        group_room.room_id = "!group:example.com"
+        group_room.member_count = 3
+        group_room.users = {
+            self.fake_client.user: None,
+            "@some_user:example.com": None,
+            "@other_user:example.com": None,
+        }
+        group_room.invited_users = {}
+
+        self.fake_client.rooms = {
+            private_room.room_id: private_room,
+            group_room.room_id: group_room,
+        }
+
+        run_coroutine(self.callbacks.sync(Mock(spec=nio.SyncResponse)))
+
+        self.assertEqual(
+            self.callbacks._dm_index,
+            {"@invited_user:example.com": private_room.room_id},
+        )
+
+    def test_pending_messages_sent_first(self):
+        """Tests that messages parked for a room go out before newer ones once the room is ready"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.member_count = 2
+        self.fake_client.rooms = {fake_room.room_id: fake_room}
+        recipient = "@some_other_fake_user:example.com"
+        self.callbacks._dm_index[recipient] = fake_room.room_id
+
+        async def notify():
+            with patch("bot_messenger.callbacks.is_ready_to_send_message") as is_ready:
+                # The first messages arrive while the recipient has not joined yet
+                is_ready.return_value = False
+                await self.callbacks.notification(TextMessage(recipient, b"first", 5))
+                await self.callbacks.notification(TextMessage(recipient, b"second", 6))
+
+                # The room becomes ready without a member event reaching the bot
+                is_ready.return_value = True
+                await self.callbacks.notification(TextMessage(recipient, b"third", 5))
+            await asyncio.gather(*self.callbacks._send_workers.values())
+
+        with patch("bot_messenger.callbacks.SEND_BATCH_WINDOW", 0), patch(
+            "bot_messenger.callbacks.send_text_to_room", new_callable=AsyncMock
+        ) as send_text:
+            run_coroutine(notify())
+
+        self.assertEqual(len(self.callbacks.rooms_pending), 0)
+        send_text.assert_called_once_with(
+            self.fake_client, fake_room.room_id, "first\n\nsecond\n\nthird"
+        )
+
+    def test_failed_send_does_not_strand_queue(self):
+        """Tests that a failing send is logged and neither stops the room's worker nor leaves it registered"""
+        room_id = "!abcdefg:example.com"
+
+        async def notify():
+            self.callbacks._ensure_worker(room_id).put_nowait(TextMessage(room_id, b"first", 5))
+            await asyncio.gather(*self.callbacks._send_workers.values())
+            self.assertNotIn(room_id, self.callbacks._send_queues)
+            self.assertNotIn(room_id, self.callbacks._send_workers)
+
+            # Later messages get a fresh worker and are still sent
+            self.callbacks._ensure_worker(room_id).put_nowait(TextMessage(room_id, b"second", 6))
+            await asyncio.gather(*self.callbacks._send_workers.values())
+
+        with patch("bot_messenger.callbacks.SEND_BATCH_WINDOW", 0), patch(
+            "bot_messenger.callbacks.send_text_to_room",
+            new_callable=AsyncMock,
+            side_effect=[RuntimeError("connection lost"), None],
+        ) as send_text:
+            with self.assertLogs("bot_messenger.callbacks", level="ERROR"):
+                run_coroutine(notify())
+
+        self.assertEqual(self.callbacks._send_queues, {})
+        self.assertEqual(self.callbacks._send_workers, {})
+        self.assertEqual(
+            send_text.mock_calls,
+            [
+                call(self.fake_client, room_id, "first"),
+                call(self.fake_client, room_id, "second"),
+            ],
+        )
+
+    def send_batch(self, messages):
+        """Run _send_batch on messages, returning the sends made in order"""
+        sends = Mock()
+        sends.attach_mock(AsyncMock(), "send_text_to_room")
+        sends.attach_mock(AsyncMock(), "send_message_to_room")
+
+        with patch(
+            "bot_messenger.callbacks.send_text_to_room", sends.send_text_to_room
+        ), patch(
+            "bot_messenger.callbacks.send_message_to_room", sends.send_message_to_room
+        ):
+            run_coroutine(self.callbacks._send_batch("!room:example.com", messages))
+
+        return sends.mock_calls
+
+    def test_send_batch_merges_texts_in_order(self):
+        """Tests that consecutive text messages are sent as one message, in arrival order"""
+        messages = [
+            TextMessage("!room:example.com", text, len(text))
+            for text in (b"first", b"second", b"third")
+        ]
+
+        self.assertEqual(
+            self.send_batch(messages),
+            [
+                call.send_text_to_room(
+                    self.fake_client, "!room:example.com", "first\n\nsecond\n\nthird"
+                )
+            ],
+        )
+
+    def test_send_batch_keeps_html_and_media_apart(self):
+        """Tests that HTML and media messages are sent on their own, between the merged texts"""
+        html = TextMessage("!room:example.com", b"<html><b>html</b>", 17)
+        media = MediaMessage("!room:example.com", b"hello", 5, "text/plain", "a.txt")
+        messages = [
+            TextMessage("!room:example.com", b"first", 5),
+            TextMessage("!room:example.com", b"second", 6),
+            html,
+            TextMessage("!room:example.com", b"third", 5),
+            media,
+            TextMessage("!room:example.com", b"fourth", 6),
+        ]
+
+        self.assertEqual(
+            self.send_batch(messages),
+            [
+                call.send_text_to_room(
+                    self.fake_client, "!room:example.com", "first\n\nsecond"
+                ),
+                call.send_message_to_room(self.fake_client, html),
+                call.send_text_to_room(self.fake_client, "!room:example.com", "third"),
+                call.send_message_to_room(self.fake_client, media),
+                call.send_text_to_room(self.fake_client, "!room:example.com", "fourth"),
+            ],
+        )
+
+    def test_send_batch_size_cap(self):
+        """Tests that merged texts stay under the size cap, counting escaped non-ASCII characters"""
+        # Counted in characters, all three would fit. Escaped, only two of them do.
+        text = "\u00e9" * (MAX_COALESCED_SIZE // 3 // encoded_size("\u00e9"))
+        separator_size = encoded_size("\n\n")
+        self.assertLessEqual(len(text) * 3 + separator_size * 2, MAX_COALESCED_SIZE)
+        self.assertLessEqual(encoded_size(text) * 2 + separator_size, MAX_COALESCED_SIZE)
+        self.assertGreater(encoded_size(text) * 3 + separator_size * 2, MAX_COALESCED_SIZE)
+        data = text.encode("utf-8")
+        messages = [
+            TextMessage("!room:example.com", data, len(data)) for _ in range(3)
+        ]
+
+        self.assertEqual(
+            self.send_batch(messages),
+            [
+                call.send_text_to_room(
+                    self.fake_client, "!room:example.com", text + "\n\n" + text
+                ),
+                call.send_text_to_room(self.fake_client, "!room:example.com", text),
+            ],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from bot_messenger.chat_functions import has_markdown, markdown_to_html, send_text_to_room
+
+from tests.utils import run_coroutine
+
+
+class ChatFunctionsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # run_coroutine closes the event loop it used, so give each test a fresh one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.room_send = AsyncMock(
+            return_value=nio.RoomSendResponse("$event", "!room:example.com")
+        )
+
+    def sent_content(self, message: str, **kwargs) -> dict:
+        """Send message with send_text_to_room, returning the content it was sent with"""
+        run_coroutine(
+            send_text_to_room(self.fake_client, "!room:example.com", message, **kwargs)
+        )
+        self.fake_client.room_send.assert_called_once()
+        return self.fake_client.room_send.call_args.args[2]
+
+    def test_has_markdown(self):
+        """Tests that messages are only sent as plain text when markdown would render them unchanged"""
+        plain = ["Backup finished", "Disk usage at 93%", "Done (exit code 0).", "3 jobs failed"]
+        for message in plain:
+            with self.subTest(message=message):
+                self.assertFalse(has_markdown(message))
+                self.assertEqual(markdown_to_html(message), f"<p>{message}</p>")
+
+        formatted = [
+            "**Backup** failed",
+            "Tom & Jerry",
+            "line one\nline two",
+            "1. first step",
+            "    indented code",
+            "\tindented code",
+            "tab\tseparated",
+        ]
+        for message in formatted:
+            with self.subTest(message=message):
+                self.assertTrue(has_markdown(message))
+
+    def test_send_text_to_room_plain(self):
+        """Tests that plain text is sent as a notice without a formatted body"""
+        self.assertEqual(
+            self.sent_content("Backup finished"),
+            {"msgtype": "m.notice", "body": "Backup finished"},
+        )
+
+    def test_send_text_to_room_markdown(self):
+        """Tests that markdown is converted to a formatted body, leaving the plain body as sent"""
+        self.assertEqual(
+            self.sent_content("**Backup** failed", notice=False),
+            {
+                "msgtype": "m.text",
+                "body": "**Backup** failed",
+                "formatted_body": "<p><strong>Backup</strong> failed</p>",
+            },
+        )
+
+    def test_send_text_to_room_html(self):
+        """Tests that HTML messages are sent as they are, without markdown conversion"""
+        self.assertEqual(
+            self.sent_content("<html><b>Backup</b> failed\n"),
+            {
+                "msgtype": "m.notice",
+                "body": "<html><b>Backup</b> failed",
+                "format": "org.matrix.custom.html",
+                "formatted_body": "<html><b>Backup</b> failed",
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
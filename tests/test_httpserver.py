@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase
+
+from bot_messenger import httpserver
+from bot_messenger.messages import TextMessage
+
+
+class HttpServerTestCase(AioHTTPTestCase):
+    async def get_application(self) -> web.Application:
+        return httpserver.create_app()
+
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+
+        # The queue is created by HttpServerInstance.run(), which isn't started here
+        self.queue = asyncio.Queue(maxsize=1)
+        for name, value in (
+            ("API_KEY", "secret"),
+            ("MESSAGE_QUEUE", self.queue),
+            ("NOTIFICATIONS_ROOM_ID", None),
+        ):
+            patcher = patch.object(httpserver, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def post(self, data: bytes, api_key: str = "secret", content_type: str = "text/plain"):
+        return await self.client.post(
+            "/",
+            data=data,
+            headers={
+                "Api-Key-Here": api_key,
+                "Content-Type": content_type,
+                "Send-To": "!room:example.com",
+            },
+        )
+
+    async def test_accepts_message(self):
+        """Tests that a valid notification is queued for the callback workers"""
+        response = await self.post(b"hello")
+
+        self.assertEqual(response.status, 202)
+        message = self.queue.get_nowait()
+        self.assertIsInstance(message, TextMessage)
+        self.assertEqual(message.recipient_room_id, "!room:example.com")
+        self.assertEqual(message.get_content(), "hello")
+
+    async def test_rejects_wrong_api_key(self):
+        """Tests that requests without the right API key are refused and nothing is queued"""
+        response = await self.post(b"hello", api_key="wrong")
+
+        self.assertEqual(response.status, 401)
+        self.assertTrue(self.queue.empty())
+
+    async def test_rejects_oversized_body(self):
+        """Tests that a body declared larger than MAX_BODY_SIZE is refused before it is read"""
+        with patch.object(httpserver, "MAX_BODY_SIZE", 16):
+            response = await self.post(b"x" * 32)
+
+        self.assertEqual(response.status, 413)
+        self.assertTrue(self.queue.empty())
+
+    async def test_rejects_when_queue_full(self):
+        """Tests that messages are refused with 503 and Retry-After while the queue is full"""
+        self.assertEqual((await self.post(b"first")).status, 202)
+
+        response = await self.post(b"second")
+
+        self.assertEqual(response.status, 503)
+        self.assertIn("Retry-After", response.headers)
+        self.assertEqual(self.queue.qsize(), 1)
+
+    async def test_rejects_malformed_multipart(self):
+        """Tests that a multipart body without a usable boundary is answered with 400"""
+        response = await self.post(b"garbage\r\n", content_type="multipart/form-data")
+
+        self.assertEqual(response.status, 400)
+        self.assertTrue(self.queue.empty())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import Mock
+
+from bot_messenger.messages import BaseMessage
+from bot_messenger.pending import PendingStore
+
+
+class PendingStoreTestCase(unittest.TestCase):
+    def test_drain(self):
+        """Tests that messages are drained per room in arrival order"""
+        store = PendingStore()
+        first, second, other = (Mock(spec=BaseMessage) for _ in range(3))
+
+        store.append("!room:example.com", "@user:example.com", first)
+        store.append("!other_room:example.com", "@other_user:example.com", other)
+        store.append("!room:example.com", "@user:example.com", second)
+
+        self.assertEqual(store.owner("!room:example.com"), "@user:example.com")
+        self.assertEqual(store.drain("!room:example.com"), [first, second])
+        self.assertIsNone(store.owner("!room:example.com"))
+        self.assertNotIn("!room:example.com", store)
+        self.assertEqual(store.drain("!room:example.com"), [])
+        self.assertEqual(len(store), 1)
+
+    def test_limits(self):
+        """Tests that the oldest messages are dropped once a limit is exceeded"""
+        store = PendingStore(max_messages=3, max_room_messages=2)
+        messages = [Mock(spec=BaseMessage) for _ in range(4)]
+
+        # The per-room limit drops the oldest message of that room
+        self.assertEqual(store.append("!room:example.com", "@user:example.com", messages[0]), [])
+        self.assertEqual(store.append("!room:example.com", "@user:example.com", messages[1]), [])
+        self.assertEqual(store.append("!room:example.com", "@user:example.com", messages[2]), [messages[0]])
+
+        # The global limit drops the oldest message of any room
+        self.assertEqual(
+            store.append("!other_room:example.com", "@other_user:example.com", messages[3]), []
+        )
+        self.assertEqual(len(store), 3)
+        other = Mock(spec=BaseMessage)
+        self.assertEqual(store.append("!other_room:example.com", "@other_user:example.com", other), [messages[1]])
+
+        self.assertEqual(store.drain("!room:example.com"), [messages[2]])
+        self.assertEqual(store.drain("!other_room:example.com"), [messages[3], other])
+
+
+    def test_limits_after_drain(self):
+        """Tests that messages which already left the store are never dropped again"""
+        store = PendingStore(max_messages=2, max_room_messages=2)
+        old, first, second, third = (Mock(spec=BaseMessage) for _ in range(4))
+
+        # A drained and refilled room keeps only its new messages
+        store.append("!room:example.com", "@user:example.com", old)
+        self.assertEqual(store.drain("!room:example.com"), [old])
+        self.assertEqual(store.append("!room:example.com", "@user:example.com", first), [])
+        self.assertEqual(store.append("!other_room:example.com", "@other_user:example.com", second), [])
+
+        # The global limit skips the drained message and drops the oldest stored one
+        self.assertEqual(store.append("!other_room:example.com", "@other_user:example.com", third), [first])
+        self.assertEqual(len(store), 2)
+        self.assertNotIn("!room:example.com", store)
+        self.assertEqual(store.drain("!other_room:example.com"), [second, third])
+
+        # Rooms that are repeatedly filled and drained don't grow the arrival order past the limits
+        for _ in range(10):
+            store.append("!room:example.com", "@user:example.com", Mock(spec=BaseMessage))
+            store.drain("!room:example.com")
+        self.assertLessEqual(len(store._order), 2 * store.max_messages)
+        self.assertEqual(len(store), 0)
+
+if __name__ == "__main__":
+    unittest.main()
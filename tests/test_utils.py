@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import nio
+
+from bot_messenger.utils import (
+    RATELIMIT_JITTER,
+    RATELIMIT_MAX_DELAY,
+    RATELIMIT_MAX_RETRIES,
+    ratelimit_delay,
+    with_ratelimit,
+)
+
+from tests.utils import run_coroutine
+
+
+class UtilsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # run_coroutine closes the event loop it used, so give each test a fresh one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_ratelimit_delay(self):
+        """Tests that the backoff grows, is capped and never undercuts the server's wait"""
+        for attempt in range(10):
+            delay = ratelimit_delay(None, attempt)
+            self.assertGreater(delay, 0)
+            self.assertLessEqual(delay, RATELIMIT_MAX_DELAY)
+
+        # Without jitter, later attempts wait at least as long as the uncapped earlier ones
+        with patch("bot_messenger.utils.random.uniform", return_value=0):
+            self.assertLess(ratelimit_delay(None, 0), ratelimit_delay(None, 1))
+
+        # The server's retry_after_ms wins over the cap
+        retry_after_ms = (RATELIMIT_MAX_DELAY + 10) * 1000
+        self.assertEqual(
+            ratelimit_delay(retry_after_ms, 0), retry_after_ms / 1000
+        )
+
+        # Jitter only ever adds to the wait
+        with patch("bot_messenger.utils.random.uniform", return_value=RATELIMIT_JITTER):
+            self.assertGreaterEqual(ratelimit_delay(2000, 0), 2)
+
+    def test_with_ratelimit_retries(self):
+        """Tests that rate limited calls are retried until they succeed"""
+        limited = nio.RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", 10)
+        success = nio.RoomSendResponse("$event", "!room:example.com")
+        func = AsyncMock(side_effect=[limited, success])
+
+        with patch("bot_messenger.utils.asyncio.sleep", new_callable=AsyncMock) as sleep:
+            response = run_coroutine(with_ratelimit(func)("arg", key="value"))
+
+        self.assertIs(response, success)
+        self.assertEqual(func.call_count, 2)
+        func.assert_called_with("arg", key="value")
+        sleep.assert_called_once()
+
+    def test_with_ratelimit_gives_up(self):
+        """Tests that the rate limit error is returned once the retries are used up"""
+        limited = nio.RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", 10)
+        func = AsyncMock(return_value=limited)
+
+        with patch("bot_messenger.utils.asyncio.sleep", new_callable=AsyncMock):
+            with self.assertLogs("bot_messenger.utils", level="WARNING"):
+                response = run_coroutine(with_ratelimit(func)())
+
+        self.assertIs(response, limited)
+        self.assertEqual(func.call_count, RATELIMIT_MAX_RETRIES + 1)
+
+    def test_with_ratelimit_other_errors(self):
+        """Tests that errors other than rate limits are returned without retrying"""
+        error = nio.RoomSendError("Forbidden", "M_FORBIDDEN")
+        func = AsyncMock(return_value=error)
+
+        response = run_coroutine(with_ratelimit(func)())
+
+        self.assertIs(response, error)
+        func.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()